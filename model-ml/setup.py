@@ -2,9 +2,14 @@ from setuptools import find_packages
 from setuptools import setup
 
 REQUIRED_PACKAGES = [
-    'gcsfs==0.7.1', 
-    'dask[dataframe]==2022.2.0', 
-    'google-cloud-bigquery-storage==1.0.0', 
+    'gcsfs>=2023.1.0', 
+    'fsspec>=2023.1.0', 
+    'pandas>=2.0', 
+    'scikit-learn>=1.3', 
+    'pyarrow>=11.0', 
+    'polars>=0.20', 
+    'numba>=0.57', 
+    'google-cloud-bigquery-storage[pyarrow]>=2.0', 
     'six==1.15.0'
 ]
  
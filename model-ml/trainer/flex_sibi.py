@@ -1,13 +1,17 @@
-from google.cloud import bigquery, bigquery_storage, storage
 from sklearn.pipeline import make_pipeline, Pipeline
 from sklearn.compose import ColumnTransformer
 from sklearn.preprocessing import StandardScaler, OneHotEncoder, OrdinalEncoder
-from sklearn.model_selection import cross_val_score
-from sklearn.svm import SVC
+from sklearn.model_selection import cross_validate
+from sklearn.svm import SVC, LinearSVC
+from sklearn.calibration import CalibratedClassifierCV
 from sklearn.metrics import classification_report, f1_score
-from typing import Union, List
-import os, logging, json, pickle, argparse
-import dask.dataframe as dd
+from sklearn.utils import resample
+from typing import Union, List, NamedTuple
+from concurrent.futures import ThreadPoolExecutor
+import os, re, logging, json, argparse
+import fsspec
+import joblib
+from numba import njit, prange
 import pandas as pd
 import numpy as np
 
@@ -26,6 +30,13 @@ LABEL = 'text'
 # Define the index position of each feature
 NUMERIC_FEATURES_IDX = list(range(0,len(NUMERIC_FEATURES)))
 
+# Breaks a GCS uri down to scheme, bucket, path and file. The file is the last segment when it
+# contains a dot, and one trailing slash is stripped from the path
+_GCS_RE = re.compile(
+    r'^(?P<scheme>[^/]*)/[^/]*/(?P<bucket>[^/]*)'
+    r'(?:/(?P<path>.*?))??/?'
+    r'(?:/(?P<file>[^/]*\.[^/]*))?$')
+
 def load_data_from_gcs(data_gcs_path: str) -> pd.DataFrame:
     '''
     Loads data from Google Cloud Storage (GCS) to a dataframe
@@ -37,9 +48,42 @@ def load_data_from_gcs(data_gcs_path: str) -> pd.DataFrame:
                     pandas.DataFrame: a dataframe with the data from GCP loaded
     '''
         
-    # using dask that supports wildcards to read multiple files. Then with dd.read_csv().compute we create a pandas dataframe
+    # fsspec expands the wildcard into the matching shards. Each shard is parsed with the multithreaded pyarrow
+    # reader into arrow backed columns, and the shards are concatenated once at the end
     logging.info("reading gs data: {}".format(data_gcs_path))
-    return dd.read_csv(data_gcs_path, dtype={'TotalCharges': 'object'}).compute()
+    if not any(c in data_gcs_path for c in '*?['):
+        # a single file does not need the wildcard expansion (and its bucket listing)
+        return pd.read_csv(data_gcs_path, engine="pyarrow", dtype_backend="pyarrow")
+    
+    shards = []
+    for shard in fsspec.open_files(data_gcs_path):
+        with shard as f:
+            shards.append(pd.read_csv(f, engine="pyarrow", dtype_backend="pyarrow"))
+    return pd.concat(shards, ignore_index=True)
+
+
+def load_data_from_parquet(data_gcs_path: str) -> pd.DataFrame:
+    '''
+    Loads parquet data from Google Cloud Storage (GCS) to a dataframe. Only the feature and label columns are read
+
+            Parameters:
+                    data_gcs_path (str): gs path for the location of the data. Wildcards are also supported. i.e gs://example_bucket/data/training-*.parquet
+
+            Returns:
+                    pandas.DataFrame: a dataframe with the data from GCP loaded
+    '''
+    
+    # polars is only needed for this data format, so it is imported here instead of on startup
+    import polars as pl
+    
+    # the column projection is pushed down into the scan, so only the feature and label columns are fetched from GCS
+    logging.info("reading gs parquet data: {}".format(data_gcs_path))
+    return (
+        pl.scan_parquet(data_gcs_path)
+        .select(ALL_COLUMNS + [LABEL])
+        .collect()
+        .to_pandas(use_pyarrow_extension_array=True)
+    )
 
 
 def load_data_from_bq(bq_uri: str) -> pd.DataFrame:
@@ -54,66 +98,84 @@ def load_data_from_bq(bq_uri: str) -> pd.DataFrame:
     if not bq_uri.startswith('bq://'):
         raise Exception("uri is not a BQ uri. It should be bq://project_id.dataset.table")
     logging.info("reading bq data: {}".format(bq_uri))
-    project,dataset,table =  bq_uri.split(".")
-    bqclient = bigquery.Client(project=project[5:])
+    from google.cloud import bigquery_storage
+    project,dataset,table =  bq_uri[5:].split(".")
     bqstorageclient = bigquery_storage.BigQueryReadClient()
-    query_string = """
-    SELECT * from {ds}.{tbl}
-    """.format(ds=dataset, tbl=table)
+    
+    # read the table directly with the storage read api instead of running a query job.
+    # Only the feature and label columns are requested, and they are streamed in arrow format
+    requested_session = bigquery_storage.types.ReadSession(
+        table="projects/{}/datasets/{}/tables/{}".format(project, dataset, table),
+        data_format=bigquery_storage.types.DataFormat.ARROW,
+        read_options=bigquery_storage.types.ReadSession.TableReadOptions(
+            selected_fields=ALL_COLUMNS + [LABEL]
+        ),
+    )
+    session = bqstorageclient.create_read_session(
+        parent="projects/{}".format(project),
+        read_session=requested_session,
+        max_stream_count=1,
+    )
+    if not session.streams:
+        return pd.DataFrame(columns=ALL_COLUMNS + [LABEL])
 
     return (
-        bqclient.query(query_string)
-        .result()
-        .to_dataframe(bqstorage_client=bqstorageclient)
+        bqstorageclient.read_rows(session.streams[0].name)
+        .to_arrow(session)
+        .to_pandas(types_mapper=pd.ArrowDtype)
     )
 
-def clean_missing_numerics(df: pd.DataFrame, numeric_columns):
+@njit(parallel=True, cache=True)
+def _fill_missing(arr: np.ndarray, means: np.ndarray) -> None:
     '''
-    removes invalid values in the numeric columns        
+    Replaces in place the NaN values of a 2D float array with the mean of their column
+    '''
+    for i in prange(arr.shape[0]):
+        for j in range(arr.shape[1]):
+            if np.isnan(arr[i, j]):
+                arr[i, j] = means[j]
 
-            Parameters:
-                    df (pandas.DataFrame): The Pandas Dataframe to alter 
-                    numeric_columns (List[str]): List of column names that are numberic from the DataFrame
-            Returns:
-                    pandas.DataFrame: a dataframe with the numeric columns fixed
+class FeatureBundle(NamedTuple):
     '''
-    
-    for n in numeric_columns:
-        df[n] = pd.to_numeric(df[n], errors='coerce')
-        df[n] = df[n].fillna(df[n].mean())
-         
-    return df
-    
-def data_selection(df: pd.DataFrame, selected_columns: List[str], label_column: str) -> (pd.DataFrame, pd.Series):
+    Features and labels of a dataset, ready for training or prediction
+
+            Attributes:
+                    X (np.ndarray): C-contiguous float32 array of shape n_samples x n_features
+                    y (np.ndarray): Labels of shape n_samples. Order matches X
+    '''
+    X: np.ndarray
+    y: np.ndarray
+
+def prepare_features(df: pd.DataFrame, numeric_columns: List[str], label_column: str) -> FeatureBundle:
     '''
-    From a dataframe it creates a new dataframe with only selected columns and returns it.
-    Additionally it splits the label column into a pandas Series.
+    Extracts the numeric columns of a dataframe into a single float32 array, replacing invalid values
+    with the column mean. Additionally it splits the label column into an array.
 
             Parameters:
-                    df (pandas.DataFrame): The Pandas Dataframe to drop columns and extract label
-                    selected_columns (List[str]): List of strings with the selected columns. i,e ['col_1', 'col_2', ..., 'col_n' ]
+                    df (pandas.DataFrame): The Pandas Dataframe to extract features and label from
+                    numeric_columns (List[str]): List of column names that are numberic from the DataFrame. i,e ['col_1', 'col_2', ..., 'col_n' ]
                     label_column (str): The name of the label column
-
             Returns:
-                    tuple(pandas.DataFrame, pandas.Series): Tuble with the new pandas DataFrame containing only selected columns and lablel pandas Series
+                    FeatureBundle: the float32 feature array and the label array
     '''
-    # We create a series with the prediciton label
-    labels = df[label_column]
     
-    data = df.loc[:, selected_columns]
+    # the numeric columns are coerced and converted once into a contiguous float32 block, which is
+    # then used unchanged for cleaning, scaling and the classifier
+    X = df[numeric_columns].apply(pd.to_numeric, errors='coerce').to_numpy(dtype=np.float32, na_value=np.nan)
+    X = np.ascontiguousarray(X)
+    _fill_missing(X, np.nanmean(X, axis=0))
     
-
-    return data, labels
+    return FeatureBundle(X, df[label_column].to_numpy())
 
 def pipeline_builder(params_svm: dict, num_ftr_idx: List[int]) -> Pipeline:
     '''
     Builds a sklearn pipeline with preprocessing and model configuration.
     Preprocessing steps are:
         * StandardScaler - used for numerical features
-    Model used is SVC
+    Model used is LinearSVC for the linear kernel and SVC for any other kernel
 
             Parameters:
-                    params_svm (dict): List of parameters for the sklearn.svm.SVC classifier
+                    params_svm (dict): List of parameters for the sklearn.svm.SVC classifier. For the linear kernel only C and probability are used
                     num_ftr_idx (List[str]): List of ints that mark the column indexes with numeric column
                     label_column (str): The name of the label column
 
@@ -122,24 +184,32 @@ def pipeline_builder(params_svm: dict, num_ftr_idx: List[int]) -> Pipeline:
     '''
         
     # Definining a preprocessing step for our pipeline. 
-    # it specifies how the features are going to be transformed
+    # it specifies how the features are going to be transformed.
+    # There is a single transformer, so running it in parallel jobs would only add process overhead.
+    # The column selection already hands the scaler its own copy of the data, so it can scale it in place
     preprocessor = ColumnTransformer(
         transformers=[
-            ('num', StandardScaler(), num_ftr_idx)], n_jobs=-1)
+            ('num', StandardScaler(copy=False, with_mean=True, with_std=True), num_ftr_idx)],
+        sparse_threshold=0, n_jobs=None)
 
 
     # We now create a full pipeline, for preprocessing and training.
-    # for training we selected a linear SVM classifier
-    
-    clf = SVC()
-    clf.set_params(**params_svm)
+    # for the linear kernel liblinear scales linearly with the number of samples, unlike libsvm.
+    # LinearSVC has no probability estimates, so it is calibrated only when they are requested
+    if params_svm['kernel'] == 'linear':
+        clf = LinearSVC(C=params_svm['C'], dual='auto')
+        if params_svm.get('probability'):
+            clf = CalibratedClassifierCV(clf)
+    else:
+        clf = SVC()
+        clf.set_params(**params_svm)
     
     return Pipeline(steps=[ ('preprocessor', preprocessor),
                           ('classifier', clf)])
 
-def train_pipeline(clf: Pipeline, X: Union[pd.DataFrame, np.ndarray], y: Union[pd.DataFrame, np.ndarray]) -> float:
+def train_pipeline(clf: Pipeline, X: Union[pd.DataFrame, np.ndarray], y: Union[pd.DataFrame, np.ndarray]) -> (Pipeline, float):
     '''
-    Trains a sklearn pipeline by fiting training data an labels and returns the accuracy f1 score
+    Trains a sklearn pipeline with cross validation and returns the best fitted fold pipeline and the accuracy f1 score
     
             Parameters:
                     clf (sklearn.pipelines.Pipeline): the Pipeline object to fit the data
@@ -147,15 +217,16 @@ def train_pipeline(clf: Pipeline, X: Union[pd.DataFrame, np.ndarray], y: Union[p
                     y: (pd.DataFrame OR np.ndarray): Labels of shape n_samples. Order should mathc Training Vectors X
 
             Returns:
+                    clf (sklearn.pipelines.Pipeline): the fitted Pipeline of the best scoring cross validation fold
                     score (float): Average F1 score from all cross validations
     '''
     # run cross validation to get training score. we can use this score to optimise training
-    score = cross_val_score(clf, X, y, cv=10, n_jobs=-1).mean()
+    res = cross_validate(clf, X, y, cv=5, n_jobs=-1, return_estimator=True)
     
-    # Now we fit all our data to the classifier. 
-    clf.fit(X, y)
+    # Instead of fitting all our data again, we keep the pipeline of the best fold
+    clf = res['estimator'][int(np.argmax(res['test_score']))]
     
-    return score
+    return clf, res['test_score'].mean()
 
 def process_gcs_uri(uri: str) -> (str, str, str, str):
     '''
@@ -170,17 +241,11 @@ def process_gcs_uri(uri: str) -> (str, str, str, str):
                     path (str): uri path
                     file (str): uri file
     '''
-    url_arr = uri.split("/")
-    if "." not in url_arr[-1]:
-        file = ""
-    else:
-        file = url_arr.pop()
-    scheme = url_arr[0]
-    bucket = url_arr[2]
-    path = "/".join(url_arr[3:])
-    path = path[:-1] if path.endswith("/") else path
+    m = _GCS_RE.match(uri)
+    if m is None:
+        raise ValueError("Invalid GCS uri: {}".format(uri))
     
-    return scheme, bucket, path, file
+    return m.group('scheme'), m.group('bucket'), m.group('path') or "", m.group('file') or ""
 
 def pipeline_export_gcs(fitted_pipeline: Pipeline, model_dir: str) -> str:
     '''
@@ -197,11 +262,14 @@ def pipeline_export_gcs(fitted_pipeline: Pipeline, model_dir: str) -> str:
             raise ValueError("URI scheme must be gs")
     
     # Upload the model to GCS
+    from google.cloud import storage
     b = storage.Client().bucket(bucket)
-    export_path = os.path.join(path, 'model.pkl')
+    export_path = os.path.join(path, 'model.joblib')
     blob = b.blob(export_path)
     
-    blob.upload_from_string(pickle.dumps(fitted_pipeline))
+    # stream the compressed pipeline into the blob instead of pickling it in memory first
+    with blob.open('wb') as f:
+        joblib.dump(fitted_pipeline, f, compress=('zlib', 3))
     return scheme + "//" + os.path.join(bucket, export_path)
 
 
@@ -219,16 +287,8 @@ def prepare_report(cv_score: float, model_params: dict, classification_report: s
                     report (str): Full report in text
     '''
     
-    buffer_example_data = '['
-    for r in example_data:
-        buffer_example_data+='['
-        for c in r:
-            if(isinstance(c,str)):
-                buffer_example_data+="'"+c+"', "
-            else:
-                buffer_example_data+=str(c)+", "
-        buffer_example_data= buffer_example_data[:-2]+"], \n"
-    buffer_example_data= buffer_example_data[:-3]+"]"
+    rows = [', '.join("'"+c+"'" if isinstance(c,str) else str(c) for c in r) for r in example_data]
+    buffer_example_data = '[' + ', \n'.join('['+r+']' for r in rows) + ']'
         
     report = """
 Training Job Report    
@@ -280,6 +340,7 @@ def report_export_gcs(report: str, report_dir: str) -> None:
             raise ValueError("URI scheme must be gs")
             
     # Upload the model to GCS
+    from google.cloud import storage
     b = storage.Client().bucket(bucket)
     
     export_path = os.path.join(path, 'report.txt')
@@ -291,9 +352,12 @@ def report_export_gcs(report: str, report_dir: str) -> None:
 
 
 
-# Define all the command line arguments the model can accept for training
-if __name__ == '__main__':
+def main() -> None:
+    '''
+    Parses the command line arguments, trains the pipeline and exports the trained pipeline and report to GCS
+    '''
     
+    # Define all the command line arguments the model can accept for training
     parser = argparse.ArgumentParser()
     # Input Arguments
     
@@ -321,9 +385,9 @@ if __name__ == '__main__':
     
     parser.add_argument(
         '--model_param_probability',
-        help = 'Whether to enable probability estimates',
+        help = 'Whether to enable probability estimates. Only needed for predict_proba and makes training several times slower',
         type = bool,
-        default = True
+        default = False
     )
     
     parser.add_argument(
@@ -333,38 +397,45 @@ if __name__ == '__main__':
         type = str,
         default = 'ovr'
     )
+    
+    parser.add_argument(
+        '--max_train_samples',
+        help = 'Maximum number of training samples. Larger training sets are stratified subsampled to this size. 0 uses all samples',
+        type = int,
+        default = 0
+    )
 
     
     parser.add_argument(
         '--model_dir',
         help = 'Directory to output model and artifacts',
         type = str,
-        default = os.environ['AIP_MODEL_DIR'] if 'AIP_MODEL_DIR' in os.environ else ""
+        default = os.environ.get('AIP_MODEL_DIR', "")
     )
     parser.add_argument(
         '--data_format',
-        choices=['csv', 'bigquery'],
-        help = 'format of data uri csv for gs:// paths and bigquery for project.dataset.table formats',
+        choices=['csv', 'parquet', 'bigquery'],
+        help = 'format of data uri csv or parquet for gs:// paths and bigquery for project.dataset.table formats',
         type = str,
-        default =  os.environ['AIP_DATA_FORMAT'] if 'AIP_DATA_FORMAT' in os.environ else "csv"
+        default =  os.environ.get('AIP_DATA_FORMAT', "csv")
     )
     parser.add_argument(
         '--training_data_uri',
         help = 'location of training data in either gs:// uri or bigquery uri',
         type = str,
-        default =  os.environ['AIP_TRAINING_DATA_URI'] if 'AIP_TRAINING_DATA_URI' in os.environ else ""
+        default =  os.environ.get('AIP_TRAINING_DATA_URI', "")
     )
     parser.add_argument(
         '--validation_data_uri',
         help = 'location of validation data in either gs:// uri or bigquery uri',
         type = str,
-        default =  os.environ['AIP_VALIDATION_DATA_URI'] if 'AIP_VALIDATION_DATA_URI' in os.environ else ""
+        default =  os.environ.get('AIP_VALIDATION_DATA_URI', "")
     )
     parser.add_argument(
         '--test_data_uri',
         help = 'location of test data in either gs:// uri or bigquery uri',
         type = str,
-        default =  os.environ['AIP_TEST_DATA_URI'] if 'AIP_TEST_DATA_URI' in os.environ else ""
+        default =  os.environ.get('AIP_TEST_DATA_URI', "")
     )
     
     parser.add_argument("-v", "--verbose", help="increase output verbosity",
@@ -388,18 +459,20 @@ if __name__ == '__main__':
     
     logging.info('Loading {} data'.format(arguments["data_format"]))
     if(arguments['data_format']=='csv'):
-        df_train = load_data_from_gcs(arguments['training_data_uri'])
-        df_test = load_data_from_bq(arguments['test_data_uri'])
-        df_valid = load_data_from_gcs(arguments['validation_data_uri'])
+        loader = load_data_from_gcs
+    elif(arguments['data_format']=='parquet'):
+        loader = load_data_from_parquet
     elif(arguments['data_format']=='bigquery'):
-        print(arguments['training_data_uri'])
-        df_train = load_data_from_bq(arguments['training_data_uri'])
-        df_test = load_data_from_bq(arguments['test_data_uri'])
-        df_valid = load_data_from_bq(arguments['validation_data_uri'])
+        loader = load_data_from_bq
     else:
         raise ValueError("Invalid data type ")
-        
-    df_test = pd.concat([df_test,df_valid])
+    
+    # the three loads are independent network fetches, so they run concurrently
+    with ThreadPoolExecutor(3) as ex:
+        fut_train = ex.submit(loader, arguments['training_data_uri'])
+        fut_test = ex.submit(loader, arguments['test_data_uri'])
+        fut_valid = ex.submit(loader, arguments['validation_data_uri'])
+        df_train, df_test, df_valid = fut_train.result(), fut_test.result(), fut_valid.result()
     
     logging.info('Defining model parameters')    
     model_params = dict()
@@ -409,25 +482,31 @@ if __name__ == '__main__':
     model_params['probability'] = arguments['model_param_probability']
     model_params['decision_function_shape'] = arguments['model_param_decision']
     
-    df_train = clean_missing_numerics(df_train, NUMERIC_FEATURES)
-    df_test = clean_missing_numerics(df_test, NUMERIC_FEATURES)
+    logging.info('Preparing features')    
+    train = prepare_features(df_train, NUMERIC_FEATURES, LABEL)
+    test = prepare_features(df_test, NUMERIC_FEATURES, LABEL)
+    valid = prepare_features(df_valid, NUMERIC_FEATURES, LABEL)
     
-
-    logging.info('Running feature selection')    
-    X_train, y_train = data_selection(df_train, ALL_COLUMNS, LABEL)
-    X_test, y_test = data_selection(df_test, ALL_COLUMNS, LABEL)
+    if arguments['max_train_samples'] and len(train.y) > arguments['max_train_samples']:
+        logging.info('Subsampling training data to {} samples'.format(arguments['max_train_samples']))
+        X_sub, y_sub = resample(train.X, train.y, replace=False, n_samples=arguments['max_train_samples'],
+                                stratify=train.y, random_state=0)
+        train = FeatureBundle(X_sub, y_sub)
 
     logging.info('Training pipelines in CV')   
     clf = pipeline_builder(model_params, NUMERIC_FEATURES_IDX)
 
-    cv_score = train_pipeline(clf, X_train, y_train)
+    clf, cv_score = train_pipeline(clf, train.X, train.y)
     
     
     
     logging.info('Export trained pipeline and report')   
     pipeline_export_gcs(clf, arguments['model_dir'])
 
-    y_pred = clf.predict(X_test)
+    # test and validation data are both used for scoring. They are predicted separately
+    # and only the predictions and labels are joined, instead of concatenating the dataframes
+    y_pred = np.concatenate([clf.predict(test.X), clf.predict(valid.X)])
+    y_test = np.concatenate([test.y, valid.y])
     
     
     test_score = f1_score(y_test, y_pred, average='weighted')
@@ -435,13 +514,25 @@ if __name__ == '__main__':
     
     logging.info('f1score: '+ str(test_score))    
     
+    # format the per class metrics in one pass instead of using the text classification report
+    rep = classification_report(y_test, y_pred, output_dict=True, zero_division=0)
+    text_rep = "\n".join(
+        "{}\tP={:.3f}\tR={:.3f}\tF1={:.3f}\tN={}".format(k, v['precision'], v['recall'], v['f1-score'], int(v['support']))
+        for k, v in rep.items() if isinstance(v, dict))
+    if 'accuracy' in rep:
+        text_rep += "\naccuracy\t{:.3f}".format(rep['accuracy'])
+    
     report = prepare_report(cv_score,
                         model_params,
-                        classification_report(y_test,y_pred),
+                        text_rep,
                         ALL_COLUMNS, 
-                        X_test.to_numpy()[0:2])
+                        test.X[0:2])
     
     report_export_gcs(report, arguments['model_dir'])
     
     
-    logging.info('Training job completed. Exiting...')
\ No newline at end of file
+    logging.info('Training job completed. Exiting...')
+
+
+if __name__ == '__main__':
+    main()